@@ -3,6 +3,8 @@ This node locates Aruco AR markers in images and publishes their ids and poses.
 
 Subscriptions:
    /camera/image_raw (sensor_msgs.msg.Image)
+   /camera/image_raw/compressed (sensor_msgs.msg.CompressedImage)
+       Used instead of the raw image when use_compressed is set.
    /camera/camera_info (sensor_msgs.msg.CameraInfo)
    /camera/camera_info (sensor_msgs.msg.CameraInfo)
 
@@ -19,35 +21,97 @@ Parameters:
     aruco_dictionary_id - dictionary that was used to generate markers
                           (default DICT_5X5_250)
     image_topic - image topic to subscribe to (default /camera/image_raw)
+    use_compressed - subscribe to <image_topic>/compressed
+                     (sensor_msgs.msg.CompressedImage) instead of the raw
+                     image topic (default False)
     camera_info_topic - camera info topic to subscribe to
                          (default /camera/camera_info)
+    camera_frame - camera optical frame to use (default to the frame id
+                   provided by the camera info message)
+    detect_hz - rate at which the most recent image is processed; faster
+                incoming frames are dropped (default 10.0)
+    detection_scale - factor to resize images by before detection; poses
+                      are still computed at full resolution (default 0,
+                      meaning 0.5 for images wider than 1280 px, else 1)
+    target_marker_id - id of the only marker whose pose is estimated and
+                       published (default 1)
+    opencv_threads - number of threads OpenCV may use internally; set to 1
+                     if detection hangs on AMD CPUs (default 2)
+    adaptive_thresh_win_size_min, adaptive_thresh_win_size_max,
+    adaptive_thresh_win_size_step - adaptive threshold window sweep
+                                    (default 13, 13, 10: a single window)
+    corner_refinement_method - cv2.aruco.CORNER_REFINE_* to use
+                               (default CORNER_REFINE_NONE)
+    min_marker_perimeter_rate - minimum marker perimeter relative to the
+                                image size (default 0.05)
+    polygonal_approx_accuracy_rate - polygon approximation accuracy
+                                     relative to the perimeter (default 0.05)
+    detect_inverted_marker - also detect inverted markers (default False)
 
 Author: Nathan Sprague
 Version: 10/26/2020
 
 """
 
+import os
+import threading
+
 import rclpy
 import rclpy.node
-from rclpy.qos import qos_profile_sensor_data
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.qos import HistoryPolicy, QoSProfile, ReliabilityPolicy
 from cv_bridge import CvBridge
 import numpy as np
 import cv2
-import tf_transformations
 from sensor_msgs.msg import CameraInfo
+from sensor_msgs.msg import CompressedImage
 from sensor_msgs.msg import Image
 from geometry_msgs.msg import PoseArray, Pose
+from std_msgs.msg import Header
 from ros2_aruco_interfaces.msg import ArucoMarkers
-from rcl_interfaces.msg import ParameterDescriptor, ParameterType
-import debugpy
-from collections import defaultdict, deque
+from rcl_interfaces.msg import ParameterDescriptor, ParameterType, SetParametersResult
+
+
+def rvec_to_quaternion(rvec):
+    """Convert a Rodrigues rotation vector to an (x, y, z, w) quaternion."""
+    r = np.asarray(rvec, dtype=np.float64).reshape(3)
+    theta = np.linalg.norm(r)
+    if theta < 1e-8:
+        return np.array([0.0, 0.0, 0.0, 1.0])
+    s = np.sin(theta * 0.5) / theta
+    return np.array([r[0] * s, r[1] * s, r[2] * s, np.cos(theta * 0.5)])
+
+
+def average_quaternions(quats, reference):
+    """Return the average of an (N, 4) array of unit quaternions.
 
+    Uses Markley's method: the average is the eigenvector of sum(q q^T)
+    with the largest eigenvalue, which is insensitive to the sign of
+    each input quaternion. The result is given the same sign as
+    reference (typically the most recent sample).
+    """
+    _, eigenvectors = np.linalg.eigh(quats.T @ quats)
+    avg_quat = eigenvectors[:, -1]
+    if avg_quat @ reference < 0:
+        avg_quat = -avg_quat
+    return avg_quat / np.linalg.norm(avg_quat)
+
+
+def average_pose(pos_buf, quat_buf, n, reference):
+    """Average the first n rows of the position and quaternion buffers.
+
+    Returns the mean position and the Markley average quaternion, signed
+    to match reference.
+    """
+    avg_position = pos_buf[:n].mean(axis=0)
+    avg_quat = average_quaternions(quat_buf[:n], reference)
+    return avg_position, avg_quat
 
 
 class ArucoNode(rclpy.node.Node):
     def __init__(self):
         super().__init__("aruco_node")
-        self.last_publish_time = self.get_clock().now()  # in __init__
 
         # Declare and read parameters
         self.declare_parameter(
@@ -77,6 +141,15 @@ class ArucoNode(rclpy.node.Node):
             ),
         )
 
+        self.declare_parameter(
+            name="use_compressed",
+            value=False,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_BOOL,
+                description="Subscribe to <image_topic>/compressed instead.",
+            ),
+        )
+
         self.declare_parameter(
             name="camera_info_topic",
             value="/camera/camera_info",
@@ -95,10 +168,113 @@ class ArucoNode(rclpy.node.Node):
             ),
         )
 
+        self.declare_parameter(
+            name="detect_hz",
+            value=10.0,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_DOUBLE,
+                description="Rate (Hz) at which the latest image is processed.",
+            ),
+        )
+
+        self.declare_parameter(
+            name="detection_scale",
+            value=0.0,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_DOUBLE,
+                description="Factor to resize images by before detection "
+                "(0 = auto: 0.5 for images wider than 1280 px, else 1).",
+            ),
+        )
+
+        self.declare_parameter(
+            name="target_marker_id",
+            value=1,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_INTEGER,
+                description="Id of the marker to track; others are ignored.",
+            ),
+        )
+
+        self.declare_parameter(
+            name="opencv_threads",
+            value=2,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_INTEGER,
+                description="Number of threads OpenCV may use internally.",
+            ),
+        )
+
+        # Detector tuning, defaults favour speed over the OpenCV defaults.
+        self.declare_parameter(
+            name="adaptive_thresh_win_size_min",
+            value=13,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_INTEGER,
+                description="Smallest adaptive threshold window size.",
+            ),
+        )
+
+        self.declare_parameter(
+            name="adaptive_thresh_win_size_max",
+            value=13,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_INTEGER,
+                description="Largest adaptive threshold window size.",
+            ),
+        )
+
+        self.declare_parameter(
+            name="adaptive_thresh_win_size_step",
+            value=10,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_INTEGER,
+                description="Step between adaptive threshold window sizes.",
+            ),
+        )
+
+        self.declare_parameter(
+            name="corner_refinement_method",
+            value="CORNER_REFINE_NONE",
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_STRING,
+                description="Corner refinement method (cv2.aruco.CORNER_REFINE_*).",
+            ),
+        )
+
+        self.declare_parameter(
+            name="min_marker_perimeter_rate",
+            value=0.05,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_DOUBLE,
+                description="Minimum marker perimeter relative to the image size.",
+            ),
+        )
+
+        self.declare_parameter(
+            name="polygonal_approx_accuracy_rate",
+            value=0.05,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_DOUBLE,
+                description="Polygon approximation accuracy relative to the perimeter.",
+            ),
+        )
+
+        self.declare_parameter(
+            name="detect_inverted_marker",
+            value=False,
+            descriptor=ParameterDescriptor(
+                type=ParameterType.PARAMETER_BOOL,
+                description="Also look for markers with inverted colours.",
+            ),
+        )
+
         self.marker_size = (
             self.get_parameter("marker_size").get_parameter_value().double_value
         )
         self.get_logger().info(f"Marker size: {self.marker_size}")
+        self.obj_points = self.make_obj_points(self.marker_size)
+        self.add_on_set_parameters_callback(self.parameters_callback)
 
         dictionary_id_name = (
             self.get_parameter("aruco_dictionary_id").get_parameter_value().string_value
@@ -110,6 +286,11 @@ class ArucoNode(rclpy.node.Node):
         )
         self.get_logger().info(f"Image topic: {image_topic}")
 
+        self.use_compressed = (
+            self.get_parameter("use_compressed").get_parameter_value().bool_value
+        )
+        self.get_logger().info(f"Use compressed images: {self.use_compressed}")
+
         info_topic = (
             self.get_parameter("camera_info_topic").get_parameter_value().string_value
         )
@@ -118,6 +299,36 @@ class ArucoNode(rclpy.node.Node):
         self.camera_frame = (
             self.get_parameter("camera_frame").get_parameter_value().string_value
         )
+        # Empty until camera info arrives if no camera_frame was given.
+        self.frame_id = self.camera_frame
+
+        self.detect_hz = (
+            self.get_parameter("detect_hz").get_parameter_value().double_value
+        )
+        if self.detect_hz <= 0.0:
+            self.get_logger().error(
+                "bad detect_hz: {} (must be > 0), using 10.0".format(self.detect_hz)
+            )
+            self.detect_hz = 10.0
+        self.get_logger().info(f"Detection rate: {self.detect_hz} Hz")
+
+        self.detection_scale = (
+            self.get_parameter("detection_scale").get_parameter_value().double_value
+        )
+        self.get_logger().info(f"Detection scale: {self.detection_scale}")
+
+        self.target_marker_id = (
+            self.get_parameter("target_marker_id").get_parameter_value().integer_value
+        )
+        self.get_logger().info(f"Target marker id: {self.target_marker_id}")
+
+        # Bound OpenCV's own thread pool so it doesn't compete with the
+        # executor threads and other nodes on the machine.
+        self.opencv_threads = (
+            self.get_parameter("opencv_threads").get_parameter_value().integer_value
+        )
+        self.get_logger().info(f"OpenCV threads: {self.opencv_threads}")
+        cv2.setNumThreads(self.opencv_threads)
 
         # Make sure we have a valid dictionary id:
         try:
@@ -131,14 +342,43 @@ class ArucoNode(rclpy.node.Node):
             options = "\n".join([s for s in dir(cv2.aruco) if s.startswith("DICT")])
             self.get_logger().error("valid options: {}".format(options))
 
-        # Set up subscriptions
+        # Set up subscriptions. Only the newest frame is ever processed, so a
+        # depth of 1 keeps stale images from queueing up in the RMW layer.
+        sensor_qos = QoSProfile(
+            depth=1,
+            reliability=ReliabilityPolicy.BEST_EFFORT,
+            history=HistoryPolicy.KEEP_LAST,
+        )
+        # Camera info shares the detection timer's callback group, so the two
+        # never run at the same time on the multi-threaded executor.
+        self.detect_cb_group = MutuallyExclusiveCallbackGroup()
         self.info_sub = self.create_subscription(
-            CameraInfo, info_topic, self.info_callback, qos_profile_sensor_data
+            CameraInfo,
+            info_topic,
+            self.info_callback,
+            sensor_qos,
+            callback_group=self.detect_cb_group,
         )
 
-        self.create_subscription(
-            Image, image_topic, self.image_callback, qos_profile_sensor_data
-        )
+        # Images get their own callback group so new frames keep arriving
+        # while detection runs on another executor thread.
+        self.image_cb_group = MutuallyExclusiveCallbackGroup()
+        if self.use_compressed:
+            self.create_subscription(
+                CompressedImage,
+                image_topic + "/compressed",
+                self.image_callback,
+                sensor_qos,
+                callback_group=self.image_cb_group,
+            )
+        else:
+            self.create_subscription(
+                Image,
+                image_topic,
+                self.image_callback,
+                sensor_qos,
+                callback_group=self.image_cb_group,
+            )
 
         # Set up publishers
         self.poses_pub = self.create_publisher(PoseArray, "aruco_poses", 10)
@@ -148,75 +388,241 @@ class ArucoNode(rclpy.node.Node):
         self.info_msg = None
         self.intrinsic_mat = None
         self.distortion = None
+        # Corners are undistorted up front, so solvePnP sees a pinhole camera.
+        self.zero_distortion = np.zeros(5)
 
         self.aruco_dictionary = cv2.aruco.getPredefinedDictionary(dictionary_id)
         self.aruco_parameters = cv2.aruco.DetectorParameters()
+        self.aruco_parameters.adaptiveThreshWinSizeMin = (
+            self.get_parameter("adaptive_thresh_win_size_min")
+            .get_parameter_value().integer_value
+        )
+        self.aruco_parameters.adaptiveThreshWinSizeMax = (
+            self.get_parameter("adaptive_thresh_win_size_max")
+            .get_parameter_value().integer_value
+        )
+        self.aruco_parameters.adaptiveThreshWinSizeStep = (
+            self.get_parameter("adaptive_thresh_win_size_step")
+            .get_parameter_value().integer_value
+        )
+        self.aruco_parameters.minMarkerPerimeterRate = (
+            self.get_parameter("min_marker_perimeter_rate")
+            .get_parameter_value().double_value
+        )
+        self.aruco_parameters.polygonalApproxAccuracyRate = (
+            self.get_parameter("polygonal_approx_accuracy_rate")
+            .get_parameter_value().double_value
+        )
+        self.aruco_parameters.detectInvertedMarker = (
+            self.get_parameter("detect_inverted_marker")
+            .get_parameter_value().bool_value
+        )
+
+        refinement_name = (
+            self.get_parameter("corner_refinement_method")
+            .get_parameter_value().string_value
+        )
+        self.get_logger().info(f"Corner refinement: {refinement_name}")
+        try:
+            if not refinement_name.startswith("CORNER_REFINE_"):
+                raise AttributeError
+            self.aruco_parameters.cornerRefinementMethod = getattr(
+                cv2.aruco, refinement_name
+            )
+        except AttributeError:
+            self.get_logger().error(
+                "bad corner_refinement_method: {}".format(refinement_name)
+            )
+            options = "\n".join(
+                [s for s in dir(cv2.aruco) if s.startswith("CORNER_REFINE_")]
+            )
+            self.get_logger().error("valid options: {}".format(options))
+
         self.aruco_detector = cv2.aruco.ArucoDetector(self.aruco_dictionary, self.aruco_parameters)
 
         self.bridge = CvBridge()
 
+        # Output messages are filled in place each frame rather than
+        # allocated anew; both share one header.
+        self.header_msg = Header()
+        self.markers_msg = ArucoMarkers(header=self.header_msg)
+        self.pose_array_msg = PoseArray(header=self.header_msg)
+        self.pose_msgs = []
+
         self.window_size = 2
-        self.pose_history = defaultdict(lambda: deque(maxlen=self.window_size))  # or change 3 to any other size
+        # Ring buffer of the target marker's last window_size positions and
+        # orientations; "i" is the next write index, "n" the number filled.
+        # Only one marker id is tracked, so a single buffer is enough.
+        self.pose_buffer = {
+            "pos": np.zeros((self.window_size, 3)),
+            "quat": np.zeros((self.window_size, 4)),
+            "i": 0,
+            "n": 0,
+        }
+
+        # Only the most recent image is kept; the timer below processes it at
+        # detect_hz, so frames arriving faster than that are simply dropped.
+        self.latest_msg = None
+        self.latest_msg_lock = threading.Lock()
+        self.detect_timer = self.create_timer(
+            1.0 / self.detect_hz,
+            self._process_latest,
+            callback_group=self.detect_cb_group,
+        )
+
+    @staticmethod
+    def make_obj_points(marker_size):
+        # Marker corners in the marker frame, in ArUco corner order. This is
+        # also the order SOLVEPNP_IPPE_SQUARE requires.
+        half = marker_size / 2
+        return np.array([
+            [-half,  half, 0],
+            [ half,  half, 0],
+            [ half, -half, 0],
+            [-half, -half, 0]
+        ], dtype=np.float32)
+
+    def parameters_callback(self, params):
+        # Validate everything first so a rejected update leaves no side effects.
+        for param in params:
+            if param.name == "marker_size" and param.value <= 0.0:
+                return SetParametersResult(
+                    successful=False,
+                    reason="marker_size must be > 0, got {}".format(param.value),
+                )
+
+        for param in params:
+            if param.name == "marker_size":
+                self.marker_size = param.value
+                self.obj_points = self.make_obj_points(self.marker_size)
+                self.get_logger().info(f"Marker size: {self.marker_size}")
+        return SetParametersResult(successful=True)
 
     def info_callback(self, info_msg):
+        # Contiguous float64, as solvePnP expects, so no per-call conversion.
+        self.intrinsic_mat = np.array(info_msg.k, dtype=np.float64).reshape(3, 3)
+        self.distortion = np.array(info_msg.d, dtype=np.float64)
+        if self.frame_id == "":
+            self.frame_id = info_msg.header.frame_id
+        # Set last: detection treats info_msg as "everything above is ready".
         self.info_msg = info_msg
-        self.intrinsic_mat = np.reshape(np.array(self.info_msg.k), (3, 3))
-        self.distortion = np.array(self.info_msg.d)
         # Assume that camera parameters will remain the same...
         self.destroy_subscription(self.info_sub)
 
 
+    def image_to_mono(self, img_msg):
+        if isinstance(img_msg, CompressedImage):
+            data = np.frombuffer(img_msg.data, dtype=np.uint8)
+            return cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+
+        # Common encodings are read straight out of the message buffer, which
+        # avoids the extra copy cv_bridge makes; anything else goes through
+        # cv_bridge.
+        if img_msg.encoding not in ("mono8", "rgb8", "bgr8"):
+            return self.bridge.imgmsg_to_cv2(img_msg, desired_encoding="mono8")
+
+        channels = 1 if img_msg.encoding == "mono8" else 3
+        data = np.frombuffer(img_msg.data, dtype=np.uint8)
+        # Don't let anything downstream write into the ROS message buffer.
+        data.flags.writeable = False
+        rows = data.reshape(img_msg.height, img_msg.step)
+        image = rows[:, :img_msg.width * channels]
+        if channels == 1:
+            return image
+
+        image = image.reshape(img_msg.height, img_msg.width, 3)
+        if img_msg.encoding == "rgb8":
+            return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
     def image_callback(self, img_msg):
+        with self.latest_msg_lock:
+            self.latest_msg = img_msg
+
+    def _process_latest(self):
+        with self.latest_msg_lock:
+            img_msg = self.latest_msg
+            self.latest_msg = None
+        if img_msg is None:
+            return
+
         if self.info_msg is None:
             self.get_logger().warn("No camera info has been received!")
             return
 
-        current_time = self.get_clock().now()
-        # if (current_time - self.last_publish_time).nanoseconds < 0.5 * 1e9:  # 0.5s = 2Hz
-        #     return
-        self.last_publish_time = current_time
-
+        # Nobody is listening, so don't spend time on detection.
+        if (
+            self.poses_pub.get_subscription_count() == 0
+            and self.markers_pub.get_subscription_count() == 0
+        ):
+            return
 
-        cv_image = self.bridge.imgmsg_to_cv2(img_msg, desired_encoding="mono8")
+        cv_image = self.image_to_mono(img_msg)
+        if cv_image is None:
+            self.get_logger().warn("Could not decode compressed image!")
+            return
         # cv2.imshow("ArucoNode input image", cv_image)
         # cv2.waitKey(1)
-        markers = ArucoMarkers()
-        pose_array = PoseArray()
-        if self.camera_frame == "":
-            markers.header.frame_id = self.info_msg.header.frame_id
-            pose_array.header.frame_id = self.info_msg.header.frame_id
-        else:
-            markers.header.frame_id = self.camera_frame
-            pose_array.header.frame_id = self.camera_frame
-
-        markers.header.stamp = img_msg.header.stamp
-        pose_array.header.stamp = img_msg.header.stamp
+        # Reuse the preallocated output messages; publish() serializes them
+        # immediately, so refilling them on the next frame is safe.
+        markers = self.markers_msg
+        pose_array = self.pose_array_msg
+        del markers.poses[:]
+        del markers.marker_ids[:]
+        del pose_array.poses[:]
+        self.header_msg.frame_id = self.frame_id
+        self.header_msg.stamp = img_msg.header.stamp
 
         # corners, marker_ids, rejected = cv2.aruco.detectMarkers(
         #     cv_image, self.aruco_dictionary, parameters=self.aruco_parameters
         # )
-        corners, marker_ids, rejected = self.aruco_detector.detectMarkers(cv_image)
+        scale = self.detection_scale
+        if scale <= 0.0:
+            scale = 0.5 if cv_image.shape[1] > 1280 else 1.0
+        if scale != 1.0:
+            detect_image = cv2.resize(
+                cv_image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+        else:
+            detect_image = cv_image
+
+        corners, marker_ids, rejected = self.aruco_detector.detectMarkers(detect_image)
         if marker_ids is not None:
+            # Only the target marker is tracked, so drop the others before
+            # paying for a pose estimate.
+            keep = np.where(marker_ids.flatten() == self.target_marker_id)[0]
+            corners = [corners[idx] for idx in keep]
+            marker_ids = marker_ids[keep]
+
+            # Map corners back to full-resolution pixel coordinates. resize()
+            # aligns pixel centres, so offset by half a pixel either side.
+            if scale != 1.0:
+                corners = [(corner + 0.5) / scale - 0.5 for corner in corners]
+
             if cv2.__version__ > "4.0.0":
                 rvecs = []
                 tvecs = []
 
-                # Loop over detected markers
-                for corner in corners:
-                    obj_points = np.array([
-                        [-self.marker_size / 2,  self.marker_size / 2, 0],
-                        [ self.marker_size / 2,  self.marker_size / 2, 0],
-                        [ self.marker_size / 2, -self.marker_size / 2, 0],
-                        [-self.marker_size / 2, -self.marker_size / 2, 0]
-                    ], dtype=np.float32)
-
-                    img_points = corner[0].astype(np.float32)
+                # Convert all corners in one go, shape (N, 4, 2), and remove
+                # lens distortion from all of them in a single call so that
+                # solvePnP doesn't have to per marker.
+                all_img_points = np.asarray(corners, dtype=np.float32).reshape(-1, 4, 2)
+                if len(all_img_points):
+                    all_img_points = cv2.undistortPoints(
+                        all_img_points.reshape(-1, 1, 2),
+                        self.intrinsic_mat,
+                        self.distortion,
+                        P=self.intrinsic_mat,
+                    ).reshape(-1, 4, 2)
 
+                # Loop over detected markers
+                for img_points in all_img_points:
                     retval, rvec, tvec = cv2.solvePnP(
-                        obj_points,
+                        self.obj_points,
                         img_points,
                         self.intrinsic_mat,
-                        self.distortion
+                        self.zero_distortion,
+                        flags=cv2.SOLVEPNP_IPPE_SQUARE
                     )
 
                     rvecs.append(rvec)
@@ -227,39 +633,32 @@ class ArucoNode(rclpy.node.Node):
                     corners, self.marker_size, self.intrinsic_mat, self.distortion
                 )
 
-            
-            
             for i, marker_id in enumerate(marker_ids):
-                
                 marker_id = marker_id[0]
-                if marker_id != 1:  
-                    continue  # Skip marker ID 1
-                    
+
                 # Compute pose
                 #position = np.array(tvecs[i][0])
                 position = np.array(tvecs[i].reshape(3,))
 
-                rot_matrix = np.eye(4)
-                rot_matrix[0:3, 0:3] = cv2.Rodrigues(rvecs[i].flatten())[0]
-                quat = tf_transformations.quaternion_from_matrix(rot_matrix)
+                quat = rvec_to_quaternion(rvecs[i])
 
                 # Add to history
-                self.pose_history[marker_id].append((position, quat))
+                buf = self.pose_buffer
+                idx = buf["i"] % self.window_size
+                buf["pos"][idx] = position
+                buf["quat"][idx] = quat
+                buf["i"] += 1
+                buf["n"] = min(buf["n"] + 1, self.window_size)
 
                 # Compute averaged pose
-                poses = self.pose_history[marker_id]
-                avg_position = np.mean([p[0] for p in poses], axis=0)
-                
-                # Average quaternion using Slerp-like method (simplified)
-                quats = np.array([p[1] for p in poses])
-                avg_quat = quats[0]
-                if len(quats) > 1:
-                    for q in quats[1:]:
-                        avg_quat = tf_transformations.quaternion_slerp(avg_quat, q, 0.5)
-                avg_quat = avg_quat / np.linalg.norm(avg_quat)
+                avg_position, avg_quat = average_pose(
+                    buf["pos"], buf["quat"], buf["n"], quat
+                )
 
                 # Populate ROS Pose
-                pose = Pose()
+                if i == len(self.pose_msgs):
+                    self.pose_msgs.append(Pose())
+                pose = self.pose_msgs[i]
                 pose.position.x, pose.position.y, pose.position.z = avg_position
                 pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w = avg_quat
 
@@ -272,15 +671,22 @@ class ArucoNode(rclpy.node.Node):
             self.markers_pub.publish(markers)
 
 def main():
+    # Only pull in debugpy (and block waiting for a client) when explicitly
+    # requested, e.g. ARUCO_DEBUGPY=1 ros2 run ros2_aruco aruco_node
+    if os.environ.get("ARUCO_DEBUGPY"):
+        import debugpy
+
+        debugpy.listen(("localhost", 5678))  # Port for debugger to connect
+        print("Waiting for debugger to attach...")
+        debugpy.wait_for_client()  # Ensures the debugger connects before continuing
+        print("Debugger connected.")
 
-    # debugpy.listen(("localhost", 5678))  # Port for debugger to connect
-    # print("Waiting for debugger to attach...")
-    # debugpy.wait_for_client()  # Ensures the debugger connects before continuing
-    # print("Debugger connected.")
-        
     rclpy.init()
     node = ArucoNode()
-    rclpy.spin(node)
+    # One thread receives images while the other runs detection.
+    executor = MultiThreadedExecutor(num_threads=2)
+    executor.add_node(node)
+    executor.spin()
 
     node.destroy_node()
     rclpy.shutdown()